@@ -1,27 +1,50 @@
 import os
+import sys
+import subprocess
 import re
-print("Importing logging...")
+import weakref
+import hashlib
+import json
+from collections import OrderedDict, deque
 import logging
-print("Importing asyncio...")
+from logging.handlers import RotatingFileHandler
 import asyncio
-print("Importing dotenv...")
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import time
+import aiohttp
+import httpx
+import diskcache
+from cachetools import TTLCache
 from dotenv import load_dotenv
-print("Importing aiogram...")
+
+# Load environment variables
+load_dotenv()
+
+# CPU thread caps for the embedding model. They must be in the environment before
+# torch / onnxruntime are imported; one process serves many chats, and the default of
+# one thread per core per library oversubscribes the CPU.
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "4"))
+os.environ.setdefault("OMP_NUM_THREADS", str(EMBED_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(EMBED_THREADS))
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.utils.chat_action import ChatActionSender
-print("Importing chromadb...")
-import chromadb
-print("Importing sentence_transformers...")
-from sentence_transformers import SentenceTransformer
-print("Importing openai...")
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from openai import AsyncOpenAI
-print("Importing ingest...")
-import ingest
-print("Imports done.")
 
-# Load environment variables
-load_dotenv()
+# torch, transformers, numba, chromadb and ingest (which pulls in PyMuPDF and pandas) take
+# seconds to import; _init_ml() loads them from main() instead, torch and transformers
+# only when the model runs on PyTorch.
+torch = chromadb = ingest = None
 
 # Configuration
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -30,18 +53,41 @@ ROUTER_BASE_URL = os.getenv("ROUTER_BASE_URL")
 VECTOR_DB_DIR = "vector_db"
 EMBEDDING_MODEL_NAME = "intfloat/multilingual-e5-small"
 LOGS_DIR = "logs"
+LLM_CACHE_DIR = "llm_cache"
+LLM_CACHE_TTL = 24 * 3600  # seconds
 MODEL_DIR = os.path.join("models", "e5-small")
+# ONNX export of the same model, used instead of PyTorch when present:
+# optimum-cli export onnx --model intfloat/multilingual-e5-small --task feature-extraction models/e5-small-onnx
+ONNX_MODEL_DIR = os.path.join("models", "e5-small-onnx")
+EMBEDDING_MAX_LENGTH = 512
+# Optional shared embedding server (Infinity / TEI, OpenAI-compatible /embeddings).
+# When set, the bot does not load the model itself.
+EMBEDDING_SERVER_URL = os.getenv("EMBEDDING_SERVER_URL")
+EMBEDDING_SERVER_MODEL = os.getenv("EMBEDDING_SERVER_MODEL", EMBEDDING_MODEL_NAME)
+# Telegram user ids allowed to run /refresh, comma-separated
+ADMIN_IDS = frozenset(int(uid) for uid in os.getenv("ADMIN_IDS", "").split(",") if uid.strip())
 
 # Setup logging
 os.makedirs(LOGS_DIR, exist_ok=True)
 logging.basicConfig(
-    filename=os.path.join(LOGS_DIR, "bot.log"),
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[
+        RotatingFileHandler(
+            os.path.join(LOGS_DIR, "bot.log"),
+            maxBytes=10_000_000,
+            backupCount=3,
+            encoding="utf-8",
+        )
+    ],
 )
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 logging.getLogger().addHandler(console_handler)
+# Library chatter stays out of the hot path
+logging.getLogger("aiogram").setLevel(logging.WARNING)
+logging.getLogger("chromadb").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 print("Starting bot...")
 
@@ -52,31 +98,465 @@ if not TELEGRAM_TOKEN:
     exit(1)
 
 print("Token found, initializing bot...")
-bot = Bot(token=TELEGRAM_TOKEN)
+# aiogram's default session already pools and keeps connections alive; it is only
+# built here to hand it orjson for Telegram API payloads when that is installed
+if orjson is not None:
+    bot_session = AiohttpSession(
+        json_loads=orjson.loads,
+        json_dumps=lambda obj: orjson.dumps(obj).decode(),
+    )
+else:
+    bot_session = AiohttpSession()
+bot = Bot(token=TELEGRAM_TOKEN, session=bot_session)
 dp = Dispatcher()
 
-# Initialize ChromaDB and Embedding Model
-try:
-    chroma_client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
-    collection = chroma_client.get_or_create_collection(name="legal_rag")
-    if os.path.isdir(MODEL_DIR):
-        embedding_model = SentenceTransformer(MODEL_DIR)
+def open_collection():
+    """Opens a persistent Chroma client and its legal_rag collection.
+
+    Returns (client, collection, system). The System is recorded here because
+    client._system looks it up by path in Chroma's shared cache, which
+    reopen_collection clears to get a fresh one.
+    """
+    client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
+    opened = client.get_or_create_collection(
+        name="legal_rag", metadata=ingest.COLLECTION_METADATA
+    )
+    return client, opened, client._system
+
+
+def _open_fresh_collection():
+    # PersistentClient reuses the System cached for the path, whose HNSW index predates
+    # the ingest run; forgetting it makes the new client start its own. The old client
+    # keeps working on its System until reopen_collection stops it.
+    chromadb.api.client.SharedSystemClient.clear_system_cache()
+    return open_collection()
+
+
+class CollectionGate:
+    """Lets Chroma queries run concurrently and lets reopen_collection wait until none is."""
+
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.running = 0
+        self.closed = False
+
+    @contextlib.asynccontextmanager
+    async def query(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.closed)
+            self.running += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.closed)
+            self.closed = True
+            await self.condition.wait_for(lambda: self.running == 0)
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.closed = False
+                self.condition.notify_all()
+
+
+collection_gate = CollectionGate()
+
+
+async def reopen_collection():
+    """Switches to a new Chroma client so the bot sees what a separate ingest process wrote.
+
+    The new client is opened first; if that fails the old one stays in use.
+    """
+    global chroma_client, collection, chroma_system
+    new_client, new_collection, new_system = await asyncio.to_thread(_open_fresh_collection)
+    async with collection_gate.exclusive():
+        old_system = chroma_system
+        chroma_client, collection, chroma_system = new_client, new_collection, new_system
+        clear_query_caches()
+    # Client.close() stops whichever System is cached for the path, i.e. the new one,
+    # so the old System is stopped directly to release its HNSW index and SQLite handles
+    await asyncio.to_thread(old_system.stop)
+    logging.info("Collection reopened, %d chunks", await asyncio.to_thread(collection.count))
+
+def _init_ml():
+    """Imports the ML stack, opens ChromaDB and loads the query embedding model."""
+    global torch, chromadb, ingest, chroma_client, collection, chroma_system
+    global embedding_backend, embedding_tokenizer, embedding_model, embedding_device
+    global _mmr_select
+    import chromadb
+    import ingest
+    try:
+        from numba import njit
+    except ImportError:
+        pass
     else:
-        embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-    logging.info("ChromaDB and Embedding Model initialized successfully.")
-except Exception as e:
-    logging.error(f"Initialization error: {e}")
-    exit(1)
+        _mmr_select = njit(cache=True)(_mmr_select)
+
+    chroma_client, collection, chroma_system = open_collection()
+    embedding_backend = None
+    if EMBEDDING_SERVER_URL:
+        embedding_backend = "remote"
+        embedding_tokenizer = embedding_model = None
+        logging.info("ChromaDB initialized, using embedding server %s", EMBEDDING_SERVER_URL)
+    elif os.path.isdir(ONNX_MODEL_DIR):
+        try:
+            # The same encoder class as ingestion, so queries and chunks are embedded alike
+            embedding_model = ingest.OnnxEmbeddingModel(
+                ONNX_MODEL_DIR, EMBEDDING_MAX_LENGTH, num_threads=EMBED_THREADS
+            )
+            embedding_backend = "onnx"
+            embedding_tokenizer = None
+            logging.info("ChromaDB and ONNX Embedding Model initialized successfully.")
+        except ImportError:
+            logging.info("optimum[onnxruntime] is not installed, using PyTorch")
+    if embedding_backend is None:
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        torch.set_num_threads(EMBED_THREADS)
+        torch.set_num_interop_threads(1)
+        embedding_backend = "torch"
+        # Plain HF tokenizer + model instead of SentenceTransformer: e5 is mean pooling +
+        # L2 normalization, which _encode_batch does directly without the ST glue per call.
+        model_source = MODEL_DIR if os.path.isdir(MODEL_DIR) else EMBEDDING_MODEL_NAME
+        embedding_device = "cuda" if torch.cuda.is_available() else "cpu"
+        embedding_tokenizer = AutoTokenizer.from_pretrained(model_source, use_fast=True)
+        embedding_model = AutoModel.from_pretrained(model_source).to(embedding_device).eval()
+        embedding_model = ingest.apply_precision(embedding_model, embedding_device)
+        logging.info("ChromaDB and Embedding Model initialized successfully.")
 
 # Initialize RouterAI Client
+# One pooled HTTP/2 client for all calls, so warm requests skip the TCP+TLS handshake
+# (pool limits go on the transport: httpx ignores client-level http2/limits when a transport is given)
+router_http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        # httpx drops idle connections after 5 s by default; chat traffic is bursty with longer gaps
+        limits=httpx.Limits(
+            max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0
+        ),
+    ),
+)
 router_client = AsyncOpenAI(
     api_key=ROUTER_API_KEY,
-    base_url=ROUTER_BASE_URL
+    base_url=ROUTER_BASE_URL,
+    http_client=router_http_client,
+    max_retries=3,
 )
 
+# Dedicated pool for query embedding so the BERT forward pass never runs on the event loop.
+# Threads (not processes) share the already loaded model instead of copying it.
+_encode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="encode")
+
+
+EMBED_MAX_BATCH = 32
+EMBED_MAX_WAIT_MS = 15  # how long to wait for more queries before encoding a batch
+
+
+def _encode_batch_torch(texts):
+    with torch.inference_mode():
+        batch = embedding_tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=EMBEDDING_MAX_LENGTH,
+            return_tensors="pt",
+        ).to(embedding_device)
+        hidden = embedding_model(**batch).last_hidden_state
+        mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        embeddings = torch.nn.functional.normalize(embeddings, dim=-1)
+    return embeddings.float().cpu().numpy()
+
+
+def _encode_batch(texts):
+    """Encodes a batch of queries; runs inside _encode_pool and returns a float32 (n, dim) array."""
+    if embedding_backend == "onnx":
+        return embedding_model.encode_batch(texts)
+    return _encode_batch_torch(texts)
+
+
+# Persistent keep-alive session to EMBEDDING_SERVER_URL, opened in main()
+_embed_session = None
+
+
+async def _encode_remote(texts):
+    """Encodes a batch of queries on the embedding server."""
+    async with _embed_session.post(
+        f"{EMBEDDING_SERVER_URL.rstrip('/')}/embeddings",
+        json={"model": EMBEDDING_SERVER_MODEL, "input": texts},
+    ) as resp:
+        resp.raise_for_status()
+        payload = await resp.json()
+    data = sorted(payload["data"], key=lambda item: item["index"])
+    return np.asarray([item["embedding"] for item in data], dtype=np.float32)
+
+
+async def _encode_texts(texts):
+    if embedding_backend == "remote":
+        return await _encode_remote(texts)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_encode_pool, _encode_batch, texts)
+
+
+class EmbeddingBatcher:
+    """Coalesces queries from concurrent chats into a single encode call.
+
+    The first pending query opens a window of window_ms; everything that arrives
+    within it (up to max_batch) is encoded together and fanned back out via futures.
+    """
+
+    def __init__(self, encode, window_ms=EMBED_MAX_WAIT_MS, max_batch=EMBED_MAX_BATCH):
+        self.encode = encode
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._worker())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def embed(self, text):
+        """Submits a query and waits for its embedding."""
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, fut))
+        return await fut
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.window
+            try:
+                while len(batch) < self.max_batch:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                pass
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await self.encode(texts)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), embedding in zip(batch, embeddings):
+                if not fut.done():
+                    fut.set_result(embedding)
+
+
+embedding_batcher = EmbeddingBatcher(_encode_texts)
+
+
+# Caches for repeated queries, keyed on the normalized query text.
+# Both are cleared after /refresh since the knowledge base changes.
+EMBED_CACHE_SIZE = 2048
+RAG_CACHE_SIZE = 1024
+_embed_cache = OrderedDict()  # query_norm -> read-only float32 vector
+_rag_cache = OrderedDict()  # blake2b(query_norm) -> (documents, metadatas)
+
+
+def normalize_query(text):
+    return " ".join(text.lower().split())
+
+
+def _cache_get(cache, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache, key, value, limit):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > limit:
+        cache.popitem(last=False)
+
+
+def _rag_cache_key(query_norm):
+    return hashlib.blake2b(query_norm.encode("utf-8"), digest_size=16).digest()
+
+
+class SemanticCache:
+    """Retrieval results for recent query embeddings, reused for near-identical paraphrases.
+
+    get returns (embedding the result was retrieved for, result) or None.
+
+    Embeddings are L2-normalized, so one matrix-vector product gives the cosine
+    similarity against every cached query. Slots are overwritten oldest-first.
+    """
+
+    def __init__(self, capacity=1024, threshold=0.97):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.vectors = None  # (capacity, dim) float32, allocated on first put
+        self.results = [None] * capacity
+        self.size = 0
+        self.next_slot = 0
+
+    def get(self, embedding):
+        if not self.size:
+            return None
+        sims = self.vectors[:self.size] @ np.asarray(embedding, dtype=np.float32)
+        best = int(sims.argmax())
+        if sims[best] >= self.threshold:
+            # Copy: the slot is reused once the ring buffer wraps
+            return self.vectors[best].copy(), self.results[best]
+        return None
+
+    def put(self, embedding, result):
+        if self.vectors is None:
+            self.vectors = np.zeros((self.capacity, len(embedding)), dtype=np.float32)
+        self.vectors[self.next_slot] = embedding
+        self.results[self.next_slot] = result
+        self.next_slot = (self.next_slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def clear(self):
+        self.results = [None] * self.capacity
+        self.size = 0
+        self.next_slot = 0
+
+
+_semantic_cache = SemanticCache()
+
+
+def clear_query_caches():
+    _embed_cache.clear()
+    _rag_cache.clear()
+    _semantic_cache.clear()
+    last_retrievals.clear()
+
+
+async def embed_query_cached(query_norm, text):
+    embedding = _cache_get(_embed_cache, query_norm)
+    if embedding is None:
+        embedding = await embedding_batcher.embed(text)
+        embedding.flags.writeable = False
+        _cache_put(_embed_cache, query_norm, embedding, EMBED_CACHE_SIZE)
+    return embedding
+
+# Chroma returns RERANK_CANDIDATES hits; MMR keeps CONTEXT_DOCS of them that are relevant
+# but not near-duplicates of each other (the same clause from several copies of a ruling)
+RERANK_CANDIDATES = 15
+CONTEXT_DOCS = 7
+MMR_LAMBDA = 0.5
+
+
+# Compiled with numba's njit in _init_ml when numba is installed
+def _mmr_select(relevance, similarity, k, lam):
+    n = relevance.shape[0]
+    selected = np.empty(k, dtype=np.int64)
+    used = np.zeros(n, dtype=np.bool_)
+    for step in range(k):
+        best = -1
+        best_score = -np.inf
+        for i in range(n):
+            if used[i]:
+                continue
+            redundancy = 0.0
+            for j in range(step):
+                if similarity[i, selected[j]] > redundancy:
+                    redundancy = similarity[i, selected[j]]
+            score = lam * relevance[i] - (1.0 - lam) * redundancy
+            if score > best_score:
+                best_score = score
+                best = i
+        selected[step] = best
+        used[best] = True
+    return selected
+
+
+def mmr_rerank(query_embedding, doc_embeddings, k, lam=MMR_LAMBDA):
+    """Returns indices of k documents chosen by maximal marginal relevance."""
+    docs = np.asarray(doc_embeddings, dtype=np.float32)
+    k = min(k, docs.shape[0])
+    relevance = docs @ query_embedding
+    similarity = docs @ docs.T
+    return _mmr_select(relevance, similarity, k, lam).tolist()
+
+
+async def retrieve(chat_id, query_norm, user_query):
+    """Returns (documents, metadatas) for the query, skipping Chroma whenever a cache can answer."""
+    rag_key = _rag_cache_key(query_norm)
+    cached = _cache_get(_rag_cache, rag_key)
+    if cached is not None:
+        return cached
+
+    # 1. Embed query
+    query_embedding = await embed_query_cached(query_norm, user_query)
+
+    # 2. Query ChromaDB (sqlite/HNSW call, kept off the event loop), unless this chat's
+    # previous question was nearly the same or a paraphrase was answered recently.
+    # The per-chat anchor stays the embedding the reused results were retrieved for, so
+    # a chain of similar follow-ups cannot drift away from it without a new query.
+    last = last_retrievals.get(chat_id)
+    if last is not None and float(np.dot(last[0], query_embedding)) > FOLLOWUP_REUSE_THRESHOLD:
+        return last[1]
+    hit = _semantic_cache.get(query_embedding)
+    if hit is not None:
+        anchor, result = hit
+    else:
+        # Held until the results are cached, so /refresh cannot clear the caches in between
+        async with collection_gate.query():
+            results = await asyncio.to_thread(
+                collection.query,
+                query_embeddings=[query_embedding],
+                n_results=RERANK_CANDIDATES,
+                include=["documents", "metadatas", "embeddings"],
+            )
+            documents = results['documents'][0]
+            metadatas = results['metadatas'][0]
+            if documents:
+                selected = mmr_rerank(query_embedding, results['embeddings'][0], CONTEXT_DOCS)
+                documents = [documents[i] for i in selected]
+                metadatas = [metadatas[i] for i in selected]
+            anchor, result = query_embedding, (documents, metadatas)
+            # Shared caches only ever hold results Chroma returned for that exact query
+            _semantic_cache.put(query_embedding, result)
+            _cache_put(_rag_cache, rag_key, result, RAG_CACHE_SIZE)
+    last_retrievals[chat_id] = (anchor, result)
+    return result
+
 # In-memory history storage
-user_histories = {}
 HISTORY_LIMIT = 6  # Keep last 3 exchanges
+HISTORY_MAX_CHATS = 10_000
+HISTORY_TTL = 3600  # seconds; idle chats are forgotten after an hour
+# chat_id -> deque(maxlen=HISTORY_LIMIT)
+user_histories = TTLCache(maxsize=HISTORY_MAX_CHATS, ttl=HISTORY_TTL)
+# chat_id -> (embedding the results were retrieved for, (documents, metadatas))
+last_retrievals = TTLCache(maxsize=HISTORY_MAX_CHATS, ttl=HISTORY_TTL)
+FOLLOWUP_REUSE_THRESHOLD = 0.9
+
+# Serializes overlapping messages from the same chat so their history updates don't interleave.
+# Locks disappear automatically once no handler holds them.
+_chat_locks = weakref.WeakValueDictionary()
+
+
+def _chat_lock(chat_id):
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _chat_locks[chat_id] = lock
+    return lock
 
 SYSTEM_PROMPT = """ 
  ТЫ — ЭКСПЕРТ-СУДЕБНИК (IP LITIGATOR). 
@@ -120,68 +600,171 @@ SYSTEM_PROMPT = """
  - Приоритет отдавай Свежей практике (2024-2026). 
  """
 
+# Safety cap on each retrieved document in the prompt, not a token saving: chunks are at
+# most ingest.CHILD_CHUNK_SIZE (800) characters, so only an overlong GK4 paragraph kept
+# whole by split_gk4_article_children is ever cut
+CONTEXT_DOC_CHARS = 1200
+
+
+def _compact_prompt(text):
+    """Strips indentation/trailing spaces and collapses blank lines: fewer input tokens, same text."""
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+SYSTEM_PROMPT = _compact_prompt(SYSTEM_PROMPT)
+# Built once and shared by every request. With ROUTER_PROMPT_CACHE=1 the system prompt is marked
+# with cache_control so routers/models that support prompt caching reuse its prefill across calls.
+if os.getenv("ROUTER_PROMPT_CACHE") == "1":
+    SYSTEM_MSG = {
+        "role": "system",
+        "content": [
+            {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+        ],
+    }
+else:
+    SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Replies keyed by a hash of the full messages payload (system prompt, history, context, question)
+_llm_cache = diskcache.Cache(LLM_CACHE_DIR, size_limit=2**30)
+
+
+def _llm_cache_key(messages_payload):
+    raw = json.dumps(messages_payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+# Streaming preview: edit the status message at most every STREAM_EDIT_INTERVAL seconds
+# and only after STREAM_EDIT_MIN_CHARS new characters (Telegram allows ~1 edit/sec per chat)
+STREAM_EDIT_INTERVAL = 1.2
+STREAM_EDIT_MIN_CHARS = 400
+STREAM_PREVIEW_CHARS = 3500
+
+
+async def stream_completion(messages_payload, status_msg):
+    """Streams the RouterAI completion, showing progress in status_msg. Returns the full reply."""
+    stream = await router_client.chat.completions.create(
+        model="google/gemini-3-flash-preview",
+        messages=messages_payload,
+        temperature=0.2,
+        max_tokens=2000,
+        stream=True,
+    )
+    parts = []
+    length = 0
+    last_len = 0
+    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        length += len(delta)
+        now = time.monotonic()
+        if length - last_len >= STREAM_EDIT_MIN_CHARS and now >= next_edit:
+            reply = "".join(parts)
+            parts = [reply]
+            next_edit = now + STREAM_EDIT_INTERVAL
+            last_len = length
+            try:
+                # Show the tail so long answers keep visibly progressing
+                await status_msg.edit_text(reply[-STREAM_PREVIEW_CHARS:])
+            except TelegramRetryAfter as e:
+                next_edit = now + e.retry_after
+            except TelegramBadRequest as e:
+                logging.warning("Stream preview edit failed: %s", e)
+    return "".join(parts)
+
+WELCOME_TEXT = (
+    "Здравствуйте! Я ваш консультант по спорам в сфере поставки и купли-продажи по законодательству РФ.\n\n"
+    "Для проведения анализа опишите вашу ситуацию текстом. Укажите:\n"
+    "1. Суть спора\n"
+    "2. Позиции сторон\n"
+    "3. Ключевые обстоятельства\n\n"
+    "Я работаю только с текстом вашего вопроса, документы прикреплять не нужно."
+)
+ACK_TEXT = "Пожалуйста! Если появятся новые обстоятельства, напишите их, и я учту их в анализе."
+GREETINGS = frozenset({"привет", "здравствуйте", "добрый день", "hello", "hi", "start"})
+ACKS = frozenset({"спасибо", "благодарю", "ок", "ok", "хорошо", "понятно", "ясно", "thx", "thanks"})
+
 def chunk_text(text, size=3500):
     return [text[i:i+size] for i in range(0, len(text), size)]
 
-def extract_case_number(filename):
-    """
-    Extracts case number from filename using regex.
-    Pattern: A\\d{2}-\\d{3,}/?\\d{2,4} (Case-insensitive, handling Cyrillic 'А' and Latin 'A').
-    Example: "Дело №А40-12854-2013.docx" -> "А40-12854-2013"
-    Fallback: clean filename without extension.
-    """
-    # Pattern to look for: A\\d{2}-\\d{3,}/?\\d{2,4}
-    # Matches A40-12345-23 or A40-12345/23
-    pattern = r"([АA]\d{2}-\d{3,}[-/]\d{2,4})"
-    match = re.search(pattern, filename, re.IGNORECASE)
-    
-    if match:
-        return match.group(1).upper()
-    
-    # Fallback: clean filename without extension
-    name = os.path.splitext(filename)[0]
-    return name.replace("Delo_", "")
-
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     """Start command - clears history for a fresh start."""
     chat_id = message.chat.id
-    if chat_id in user_histories:
-        del user_histories[chat_id]
-    
-    welcome_text = (
-        "Здравствуйте! Я ваш консультант по спорам в сфере поставки и купли-продажи по законодательству РФ.\n\n"
-        "Для проведения анализа опишите вашу ситуацию текстом. Укажите:\n"
-        "1. Суть спора\n"
-        "2. Позиции сторон\n"
-        "3. Ключевые обстоятельства\n\n"
-        "Я работаю только с текстом вашего вопроса, документы прикреплять не нужно."
-    )
-    await message.answer(welcome_text)
+    # Under the chat lock, so an answer in progress cannot put the old history back
+    async with _chat_lock(chat_id):
+        user_histories.pop(chat_id, None)
+        last_retrievals.pop(chat_id, None)
+    await message.answer(WELCOME_TEXT)
 
 @dp.message(Command("reset"))
 async def cmd_reset(message: types.Message):
     """Clear conversation history."""
     chat_id = message.chat.id
-    if chat_id in user_histories:
-        del user_histories[chat_id]
+    # Under the chat lock, so an answer in progress cannot put the old history back
+    async with _chat_lock(chat_id):
+        user_histories.pop(chat_id, None)
+        last_retrievals.pop(chat_id, None)
     await message.answer("🧹 История диалога очищена. Я готов к новой теме.")
 
+# Seconds between progress edits while /refresh streams ingest output
+REFRESH_PROGRESS_INTERVAL = 5
+
+def run_ingest_process(progress):
+    """Runs ingest.py to completion, keeping its latest output line in progress[0]."""
+    with subprocess.Popen(
+        [sys.executable, "-u", "ingest.py"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env={**os.environ, "PYTHONIOENCODING": "utf-8"},
+        encoding="utf-8",
+        errors="replace",
+    ) as proc:
+        for line in proc.stdout:
+            line = line.strip()
+            if line:
+                progress[0] = line
+        return proc.wait()
+
+# Only one ingest.py may write vector_db/ at a time
+_refresh_lock = asyncio.Lock()
+
 @dp.message(Command("refresh"))
 async def cmd_refresh(message: types.Message):
     """Admin command to refresh the knowledge base."""
-    # In a real app, you should check for admin ID
-    status_msg = await message.answer("🔄 Обновление базы знаний...")
-    try:
-        # Run ingestion in a separate thread/process to not block the bot
-        # For simplicity, we call it directly but it might block if large
-        # Better to run in executor
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, ingest.ingest_documents)
-        await status_msg.edit_text("✅ База знаний успешно обновлена.")
-    except Exception as e:
-        logging.error(f"Refresh error: {e}")
-        await status_msg.edit_text(f"❌ Ошибка обновления: {e}")
+    if message.from_user is None or message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ Команда доступна только администраторам.")
+        return
+    if _refresh_lock.locked():
+        await message.answer("⏳ Обновление базы знаний уже выполняется.")
+        return
+    async with _refresh_lock:
+        status_msg = await message.answer("🔄 Обновление базы знаний...")
+        try:
+            # A separate process keeps ingestion off the bot's GIL and event loop. It is driven
+            # from a thread with subprocess.Popen rather than asyncio.create_subprocess_exec:
+            # the selector event loop used on Windows does not support subprocesses.
+            progress = [""]
+            ingest_task = asyncio.ensure_future(asyncio.to_thread(run_ingest_process, progress))
+            while not ingest_task.done():
+                await asyncio.wait({ingest_task}, timeout=REFRESH_PROGRESS_INTERVAL)
+                if not ingest_task.done() and progress[0]:
+                    try:
+                        await status_msg.edit_text(f"🔄 Обновление базы знаний...\n{progress[0][-300:]}")
+                    except TelegramBadRequest:
+                        pass
+            rc = ingest_task.result()
+            if rc != 0:
+                raise RuntimeError(f"ingest.py exited with code {rc}: {progress[0][-300:]}")
+            await reopen_collection()
+            await status_msg.edit_text("✅ База знаний успешно обновлена.")
+        except Exception as e:
+            logging.error("Refresh error: %r", e)
+            await status_msg.edit_text(f"❌ Ошибка обновления: {e or type(e).__name__}")
 
 def get_after_response_keyboard():
     buttons = [
@@ -201,17 +784,19 @@ async def process_clarify(callback: types.CallbackQuery):
 async def process_reset_callback(callback: types.CallbackQuery):
     """Callback handler to clear conversation history."""
     chat_id = callback.message.chat.id
-    logging.info(f"Reset requested for chat_id: {chat_id}")
-    if chat_id in user_histories:
-        del user_histories[chat_id]
-        logging.info(f"History deleted for chat_id: {chat_id}")
-    else:
-        logging.info(f"No history found to delete for chat_id: {chat_id}")
-    
-    # Double check deletion
-    if chat_id in user_histories:
-        logging.error(f"FAILED to delete history for chat_id: {chat_id}")
-        user_histories[chat_id] = [] # Force empty
+    logging.info("Reset requested for chat_id: %s", chat_id)
+    async with _chat_lock(chat_id):
+        last_retrievals.pop(chat_id, None)
+        if chat_id in user_histories:
+            del user_histories[chat_id]
+            logging.info("History deleted for chat_id: %s", chat_id)
+        else:
+            logging.info("No history found to delete for chat_id: %s", chat_id)
+
+        # Double check deletion
+        if chat_id in user_histories:
+            logging.error("FAILED to delete history for chat_id: %s", chat_id)
+            user_histories[chat_id] = deque(maxlen=HISTORY_LIMIT)  # Force empty
 
     await callback.message.answer("🧹 История диалога очищена. Я готов к новой теме.")
     await callback.answer()
@@ -220,123 +805,146 @@ async def process_reset_callback(callback: types.CallbackQuery):
 async def handle_message(message: types.Message):
     user_query = message.text
     chat_id = message.chat.id
-    logging.info(f"Received query: {user_query} from chat_id: {chat_id}")
-
-    # Greeting check
-    greetings = ["привет", "здравствуйте", "добрый день", "hello", "hi", "start"]
-    if user_query.lower().strip() in greetings or len(user_query.strip()) < 4:
-        welcome_text = (
-            "Здравствуйте! Я ваш консультант по спорам в сфере поставки и купли-продажи по законодательству РФ.\n\n"
-            "Для проведения анализа опишите вашу ситуацию текстом. Укажите:\n"
-            "1. Суть спора\n"
-            "2. Позиции сторон\n"
-            "3. Ключевые обстоятельства\n\n"
-            "Я работаю только с текстом вашего вопроса, документы прикреплять не нужно."
-        )
-        await message.answer(welcome_text)
+    logging.info("Received query: %s from chat_id: %s", user_query, chat_id)
+
+    # Acknowledgements and greetings need no retrieval or LLM call
+    query_key = user_query.strip().lower()
+    if query_key.strip(" .!") in ACKS:
+        await message.answer(ACK_TEXT)
         return
+    if query_key in GREETINGS or len(query_key) < 4:
+        await message.answer(WELCOME_TEXT)
+        return
+
+    async with _chat_lock(chat_id):
+        await answer_query(message, user_query, chat_id)
 
+def source_label(meta):
+    """Returns the citation label of a retrieved chunk."""
+    # Labels are precomputed at ingest; older chunks without one are labeled on the fly
+    return meta.get("source_label") or ingest.make_source_label(meta.get("filename", "Unknown"))
+
+async def answer_query(message: types.Message, user_query, chat_id):
+    """Retrieves context, asks the LLM and replies; called under the chat's lock."""
     # Get history
-    history = user_histories.get(chat_id, [])
-    logging.info(f"Current history length for chat_id {chat_id}: {len(history)}")
-    
-    status_msg = await message.answer("Думаю...")
+    history = user_histories.get(chat_id)
+    if history is None:
+        history = deque(maxlen=HISTORY_LIMIT)
+    logging.info("Current history length for chat_id %s: %s", chat_id, len(history))
     
+    # The status message is sent while the query is embedded and searched;
+    # it is only needed once the LLM call starts.
+    status_task = asyncio.create_task(message.answer("Думаю..."))
+    status_msg = None
+
     try:
-        # 1. Embed query
-        query_embedding = embedding_model.encode(user_query).tolist()
-        
-        # 2. Query ChromaDB
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=7
-        )
-        
-        documents = results['documents'][0]
-        metadatas = results['metadatas'][0]
-        
-        context_parts = []
-        for i, doc in enumerate(documents):
-            meta = metadatas[i]
-            filename = meta.get('filename', 'Unknown')
-            case_number = extract_case_number(filename)
-            
-            # Smart prefixing: don't double-add "Дело" if it's already there
-            if case_number.lower().lstrip().startswith("дело") or case_number.lower().lstrip().startswith("case"):
-                source_label = case_number
-            else:
-                source_label = f"Дело №{case_number}"
-            
-            # Format each chunk with explicit Source ID
-            context_chunk = f"SOURCE_ID: [{source_label}]\nCONTENT: {doc}"
-            context_parts.append(context_chunk)
-            
-        context_str = "\n\n---\n\n".join(context_parts)
-        
-        if not context_str:
-            context_str = "В базе знаний нет релевантных документов."
-        
+        query_norm = normalize_query(user_query)
+        documents, metadatas = await retrieve(chat_id, query_norm, user_query)
+
+        context_str = "\n\n---\n\n".join(
+            f"SOURCE_ID: [{source_label(meta)}]\nCONTENT: {doc[:CONTEXT_DOC_CHARS]}"
+            for doc, meta in zip(documents, metadatas)
+        ) or "В базе знаний нет релевантных документов."
+
         # 3. Construct Prompt
-        full_prompt = f"""
-        КОНТЕКСТ (найденные документы):
-        {context_str}
-        
-        ТЕКУЩИЙ ВОПРОС:
-        {user_query}
-        """
-        
-        # Get history (retrieved at start)
+        full_prompt = (
+            f"КОНТЕКСТ (найденные документы):\n{context_str}\n\n"
+            f"ТЕКУЩИЙ ВОПРОС:\n{user_query}"
+        )
         
-        # Construct messages list
-        messages_payload = [{"role": "system", "content": SYSTEM_PROMPT}] + history + [{"role": "user", "content": full_prompt}]
+        # Construct messages list (history retrieved at start)
+        messages_payload = [SYSTEM_MSG, *history, {"role": "user", "content": full_prompt}]
+
+        status_msg = await status_task
 
         # 4. Call RouterAI
-        async with ChatActionSender(bot=bot, chat_id=message.chat.id, action="typing"):
-            response = await router_client.chat.completions.create(
-                model="google/gemini-3-flash-preview",
-                messages=messages_payload,
-                temperature=0.2,
-                max_tokens=2000
-            )
-            
-        ai_reply = response.choices[0].message.content
+        llm_key = _llm_cache_key(messages_payload)
+        ai_reply = _llm_cache.get(llm_key)
+        if ai_reply is None:
+            async with ChatActionSender(bot=bot, chat_id=message.chat.id, action="typing"):
+                ai_reply = await stream_completion(messages_payload, status_msg)
+            # A filtered or empty completion goes to the error path: nothing to send,
+            # and an empty assistant turn in history breaks later requests on some providers
+            if not ai_reply or not ai_reply.strip():
+                raise RuntimeError("LLM returned an empty reply")
+            _llm_cache.set(llm_key, ai_reply, expire=LLM_CACHE_TTL)
+        else:
+            logging.info("LLM cache hit for chat_id: %s", chat_id)
         
         # Update history
         # Store full prompt to keep context for future turns
         history.append({"role": "user", "content": full_prompt})
         history.append({"role": "assistant", "content": ai_reply})
-        
-        # Trim history
-        if len(history) > HISTORY_LIMIT:
-            history = history[-HISTORY_LIMIT:]
-        
+        # Re-inserting refreshes the chat's TTL; the deque drops the oldest turns itself
         user_histories[chat_id] = history
         parts = chunk_text(ai_reply, 3500)
-        await status_msg.delete()
-        
-        # Send chunks, attach keyboard to the last one
+
+        # Send chunks in order, attach keyboard to the last one.
+        # The status message is deleted concurrently with the first send to save one round-trip.
         for i, part in enumerate(parts):
-            if i == len(parts) - 1:
-                await message.answer(part, reply_markup=get_after_response_keyboard())
+            markup = get_after_response_keyboard() if i == len(parts) - 1 else None
+            if i == 0:
+                await asyncio.gather(status_msg.delete(), message.answer(part, reply_markup=markup))
             else:
-                await message.answer(part)
+                await message.answer(part, reply_markup=markup)
         
     except Exception as e:
-        logging.exception(f"Error handling message: {e}")
+        logging.exception("Error handling message: %s", e)
         try:
+            if status_msg is None:
+                status_msg = await status_task
             await status_msg.edit_text("⚠️ Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже.")
         except Exception:
             await message.answer("⚠️ Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже.")
 
+def _warmup():
+    """Pays the first-call costs (graph init, HNSW load, MMR JIT) before users arrive."""
+    embeddings = _encode_batch(["warmup query"] * 8)
+    collection.query(query_embeddings=[embeddings[0]], n_results=1, include=["metadatas"])
+    mmr_rerank(embeddings[0], embeddings, 2)
+
 async def main():
+    global _embed_session
     logging.info("Bot started")
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # Bounded pool for asyncio.to_thread (ML init, warmup, Chroma queries)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    )
+    try:
+        await asyncio.to_thread(_init_ml)
+    except Exception as e:
+        logging.error("Initialization error: %s", e)
+        raise
+    if EMBEDDING_SERVER_URL:
+        _embed_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+    if embedding_backend != "remote":
+        try:
+            await asyncio.to_thread(_warmup)
+            logging.info("Warmup complete")
+        except Exception as e:
+            logging.warning("Warmup failed: %s", e)
+    embedding_batcher.start()
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        embedding_batcher.stop()
+        if _embed_session is not None:
+            await _embed_session.close()
+        await router_http_client.aclose()
 
 if __name__ == "__main__":
-    import sys
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    else:
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -1,7 +1,55 @@
 import chromadb
 import os
+import sqlite3
 
 VECTOR_DB_DIR = "vector_db"
+PAGE_SIZE = 10_000
+
+# Distinct filenames straight from Chroma's SQLite metadata table, without
+# materializing every chunk's metadata dict in Python
+FILENAMES_SQL = """
+    SELECT DISTINCT em.string_value
+    FROM embedding_metadata em
+    JOIN embeddings e ON e.id = em.id
+    JOIN segments s ON s.id = e.segment_id
+    JOIN collections c ON c.id = s.collection
+    WHERE em.key = 'filename' AND c.name = ?
+"""
+
+
+def get_indexed_filenames(collection, db_dir=VECTOR_DB_DIR):
+    """Returns the set of filenames indexed in a collection.
+
+    Reads chroma.sqlite3 directly; falls back to a paged scan through the
+    Chroma API if the SQLite schema is different.
+    """
+    db_path = os.path.join(db_dir, "chroma.sqlite3")
+    if os.path.exists(db_path):
+        try:
+            con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                rows = con.execute(FILENAMES_SQL, (collection.name,))
+                filenames = {row[0] for row in rows if row[0] is not None}
+            finally:
+                con.close()
+            if filenames or collection.count() == 0:
+                return filenames
+        except sqlite3.Error:
+            pass
+
+    filenames = set()
+    add = filenames.add
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=PAGE_SIZE, offset=offset)
+        metadatas = page["metadatas"] or []
+        for meta in metadatas:
+            if meta and "filename" in meta:
+                add(meta["filename"])
+        if len(metadatas) < PAGE_SIZE:
+            return filenames
+        offset += PAGE_SIZE
+
 
 def check_all_files():
     if not os.path.exists(VECTOR_DB_DIR):
@@ -12,16 +60,8 @@ def check_all_files():
         client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
         collection = client.get_collection(name="legal_rag")
         
-        # Get all metadata (limit to 1000 just in case, but we expect ~20)
-        data = collection.get(include=["metadatas"])
-        
-        unique_files = set()
-        total_chunks = len(data["ids"])
-        
-        if data["metadatas"]:
-            for meta in data["metadatas"]:
-                if meta and "filename" in meta:
-                    unique_files.add(meta["filename"])
+        total_chunks = collection.count()
+        unique_files = get_indexed_filenames(collection)
         
         print(f"📊 Статистика базы данных:")
         print(f"   - Всего фрагментов (chunks): {total_chunks}")
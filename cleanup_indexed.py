@@ -2,6 +2,7 @@ import os
 import logging
 import chromadb
 from dotenv import load_dotenv
+from check_full_db import get_indexed_filenames
 
 # Load environment variables
 load_dotenv()
@@ -28,15 +29,7 @@ def cleanup_indexed_files():
     # Get all indexed filenames
     print("🔍 Fetching indexed files list...")
     try:
-        # Get only metadatas to find filenames
-        result = collection.get(include=["metadatas"])
-        indexed_files = set()
-        
-        if result["metadatas"]:
-            for meta in result["metadatas"]:
-                if meta and "filename" in meta:
-                    indexed_files.add(meta["filename"])
-        
+        indexed_files = get_indexed_filenames(collection, VECTOR_DB_DIR)
         print(f"📋 Found {len(indexed_files)} unique files in the database.")
         
     except Exception as e:
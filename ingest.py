@@ -1,16 +1,35 @@
 import os
+import sys
 import hashlib
+import bisect
+import mmap
+import functools
 import re
 import logging
-import chromadb
+from logging.handlers import RotatingFileHandler
 import json
 import shutil
-from sentence_transformers import SentenceTransformer
-import docx
+import zipfile
+from lxml import etree
 import fitz  # PyMuPDF
 import pandas as pd
 from dotenv import load_dotenv
 import gc
+from collections import OrderedDict
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+# torch, sentence-transformers and chromadb are imported inside the functions that
+# use them: extract_in_workers' processes import this module under spawn (Windows,
+# macOS) and only need the readers and the splitter
+import numpy as np
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 load_dotenv()
 
@@ -19,19 +38,60 @@ VECTOR_DB_DIR = "vector_db"
 DOC_STORE_DIR = "doc_store"
 LOGS_DIR = "logs"
 MODELS_DIR = "models"
+ONNX_MODEL_DIR = os.path.join(MODELS_DIR, "e5-small-onnx")
 
 PARENT_CHUNK_SIZE = 3000
 CHILD_CHUNK_SIZE = 800
 CHUNK_OVERLAP = 150
 EMBEDDING_MODEL_NAME = "intfloat/multilingual-e5-small"
 COLLECTION_NAME = "legal_rag"
-
-os.makedirs(LOGS_DIR, exist_ok=True)
-logging.basicConfig(
-    filename=os.path.join(LOGS_DIR, "ingest.log"),
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+# HNSW index settings, applied when a collection is created. e5 vectors are
+# L2-normalized, so cosine is the natural space; search_ef only needs to stay
+# comfortably above the n_results used by the bot.
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+    "hnsw:M": 16,
+}
+# fp32 | fp16 | int8. Use the same value for ingestion and the bot so that
+# query and corpus embeddings come from the same weights.
+EMBEDDING_PRECISION = os.getenv("E5_PRECISION", "fp32").lower()
+# SentenceTransformer.encode sorts its input by length before batching, so each batch
+# is padded only to its own longest chunk; larger batches give that sort more to work with.
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "32"))
+# CPU threads for the ingest encoder; BERT matmuls stop scaling past ~8 threads
+INGEST_THREADS = int(os.getenv("INGEST_THREADS") or min(8, os.cpu_count() or 1))
+# Worker processes that read and split files while the main process embeds; each
+# holds a document's text, so the default stays small for 8 GB machines
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS") or max(1, min(4, (os.cpu_count() or 2) // 2)))
+# Files between saves of the sidecar file index (it is also saved at the end) and gc runs
+FILE_INDEX_SAVE_EVERY = 50
+# Chunk embeddings kept for reuse within one run (~1.5 KB each for e5-small); legal
+# documents repeat a lot of boilerplate (headers, standard clauses) across files
+EMBEDDING_CACHE_SIZE = 100_000
+_embedding_cache = OrderedDict()
+# Rows per collection.upsert call; stays well under Chroma's max batch size
+ADD_BATCH_SIZE = 250
+
+
+def setup_logging():
+    # Only when run as a script: bot.py imports this module and configures its own log
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            RotatingFileHandler(
+                os.path.join(LOGS_DIR, "ingest.log"),
+                maxBytes=10_000_000,
+                backupCount=3,
+                encoding="utf-8",
+            ),
+            # stdout is streamed to the admin by the bot's /refresh command
+            logging.StreamHandler(sys.stdout),
+        ],
+    )
 
 def reset_databases():
     os.makedirs(VECTOR_DB_DIR, exist_ok=True)
@@ -42,23 +102,133 @@ def get_doc_id(filename):
     return hashlib.md5(filename.encode("utf-8")).hexdigest()
 
 
+def get_file_hash(filepath, algorithm=None):
+    """Content fingerprint "<algorithm>:<hex>" used to detect changed files.
+
+    xxh3 (SIMD, non-cryptographic) when xxhash is installed, else BLAKE2b; the file is
+    hashed through an mmap without copying it into Python buffers.
+    """
+    if algorithm is None:
+        algorithm = "xxh3" if xxhash is not None else "blake2b"
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return f"{algorithm}:{_hexdigest(algorithm, b'')}"
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return f"{algorithm}:{_hexdigest(algorithm, mm)}"
+
+
+def _hexdigest(algorithm, data):
+    if algorithm == "xxh3":
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data).hexdigest()
+
+
+# Matches A40-12345-23 or A40-12345/23 (Cyrillic 'А' or Latin 'A').
+# The pattern is purely regular, so use the RE2 DFA engine when google-re2 is installed
+# (linear time, no backtracking on odd filenames); the inline (?i) flag works in both engines.
+try:
+    import re2 as _case_re_engine
+except ImportError:
+    _case_re_engine = re
+_CASE_RE = _case_re_engine.compile(r"(?i)([АA]\d{2}-\d{3,}[-/]\d{2,4})")
+_DELO_PREFIX_RE = re.compile(r"^\s*(дело|case)", re.IGNORECASE)
+
+
+def extract_case_number(filename):
+    """
+    Extracts case number from filename using regex.
+    Pattern: A\\d{2}-\\d{3,}/?\\d{2,4} (Case-insensitive, handling Cyrillic 'А' and Latin 'A').
+    Example: "Дело №А40-12854-2013.docx" -> "А40-12854-2013"
+    Fallback: clean filename without extension.
+    """
+    match = _CASE_RE.search(filename)
+    if match:
+        return match.group(1).upper()
+    return os.path.splitext(filename)[0].replace("Delo_", "")
+
+
+@functools.lru_cache(maxsize=4096)
+def make_source_label(filename):
+    """Builds the SOURCE_ID label shown to the LLM, e.g. "Дело №А40-12854-2013"."""
+    case_number = extract_case_number(filename)
+    # Smart prefixing: don't double-add "Дело" if it's already there
+    if _DELO_PREFIX_RE.match(case_number):
+        return case_number
+    return f"Дело №{case_number}"
+
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_BODY = f"{_W_NS}body"
+_W_P = f"{_W_NS}p"
+_W_R = f"{_W_NS}r"
+_W_HYPERLINK = f"{_W_NS}hyperlink"
+_W_T = f"{_W_NS}t"
+_W_BR = f"{_W_NS}br"
+_W_BR_TYPE = f"{_W_NS}type"
+# Text equivalents of run content elements, as in python-docx's Run.text
+_W_RUN_CHARS = {
+    f"{_W_NS}tab": "\t",
+    f"{_W_NS}ptab": "\t",
+    f"{_W_NS}cr": "\n",
+    f"{_W_NS}noBreakHyphen": "-",
+}
+
+
+def _docx_run_text(run):
+    parts = []
+    for node in run:
+        if node.tag == _W_T:
+            parts.append(node.text or "")
+        elif node.tag == _W_BR:
+            # Line breaks only; page and column breaks have no text
+            if node.get(_W_BR_TYPE, "textWrapping") == "textWrapping":
+                parts.append("\n")
+        elif node.tag in _W_RUN_CHARS:
+            parts.append(_W_RUN_CHARS[node.tag])
+    return "".join(parts)
+
+
+def _docx_paragraph_text(para):
+    # Direct runs and runs of hyperlinks only: w:tab under w:pPr is a tab stop
+    # definition, and drawings/text boxes would repeat their alternate content
+    parts = []
+    for child in para:
+        if child.tag == _W_R:
+            parts.append(_docx_run_text(child))
+        elif child.tag == _W_HYPERLINK:
+            parts.extend(_docx_run_text(run) for run in child.iterchildren(_W_R))
+    return "".join(parts)
+
+
 def read_docx(filepath):
+    # Reads word/document.xml directly instead of building python-docx's object model;
+    # gives the same text as "\n".join(p.text for p in Document(filepath).paragraphs)
     try:
-        doc = docx.Document(filepath)
-        return "\n".join(p.text for p in doc.paragraphs)
+        with zipfile.ZipFile(filepath) as zf:
+            root = etree.fromstring(zf.read("word/document.xml"))
+        body = root.find(_W_BODY)
+        if body is None:
+            return ""
+        return "\n".join(_docx_paragraph_text(para) for para in body.iterchildren(_W_P))
     except Exception as e:
         logging.error(f"Error reading DOCX {filepath}: {e}")
         return None
 
 
+# PyMuPDF's plain-text flags with image blocks masked out explicitly
+PDF_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_IMAGES
+
+
 def read_pdf(filepath):
     try:
-        doc = fitz.open(filepath)
-        parts = []
-        for page in doc:
-            parts.append(page.get_text())
-        doc.close()
-        return "\n".join(parts)
+        with fitz.open(filepath) as doc:
+            pages = []
+            for page in doc:
+                # One TextPage per page, built without image blocks; its text is read once
+                textpage = page.get_textpage(flags=PDF_TEXT_FLAGS)
+                pages.append(textpage.extractText())
+                del textpage
+            return "\n".join(pages)
     except Exception as e:
         logging.error(f"Error reading PDF {filepath}: {e}")
         return None
@@ -66,63 +236,125 @@ def read_pdf(filepath):
 
 def read_excel(filepath):
     try:
-        df = pd.read_excel(filepath)
-        rows = []
-        for _, row in df.iterrows():
-            parts = []
-            for col in df.columns:
-                value = row[col]
-                if pd.notna(value):
-                    parts.append(f"{col}: {value}")
-            if parts:
-                rows.append(" | ".join(parts))
-        return "\n".join(rows)
+        return excel_frame_to_text(pd.read_excel(filepath))
     except Exception as e:
         logging.error(f"Error reading Excel {filepath}: {e}")
         return None
 
 
-def recursive_split(text, chunk_size, overlap):
-    if not text:
-        return []
-    chunks = []
-    start = 0
-    text_len = len(text)
-    while start < text_len:
-        end = min(start + chunk_size, text_len)
-        if end == text_len:
-            chunks.append(text[start:])
+def excel_frame_to_text(df):
+    """One "col: value | col: value" line per row, skipping empty cells.
+
+    Same output as formatting df.iterrows() rows, without building a Series per row:
+    df.values is exactly what iterrows slices, so numeric columns are upcast the same way.
+    """
+    values = df.values
+    if values.dtype.kind in "mM":
+        # iterrows boxes datetime64/timedelta64 cells as Timestamp/Timedelta
+        values = df.astype(object).values
+    present = df.notna().values
+    columns = list(df.columns)
+    rows = []
+    for row, mask in zip(values, present):
+        parts = [f"{col}: {value}" for col, value, ok in zip(columns, row, mask) if ok]
+        if parts:
+            rows.append(" | ".join(parts))
+    return "\n".join(rows)
+
+
+_SPLIT_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+def _split_spans(text, region_start, region_end, chunk_size, overlap, offsets):
+    """Splits text[region_start:region_end] and returns absolute (start, end) spans.
+
+    offsets caches separator positions over the whole text; they are found on first
+    use (the later separators are rarely needed) and bisected instead of running
+    rfind over every window, and can be shared between splits of the same text.
+    """
+    spans = []
+    start = region_start
+    while start < region_end:
+        end = min(start + chunk_size, region_end)
+        if end == region_end:
+            spans.append((start, region_end))
             break
         split_point = -1
         search_start = max(start, end - int(chunk_size * 0.2))
-        for sep in ["\n\n", "\n", ". ", " "]:
-            candidate = text.rfind(sep, search_start, end)
-            if candidate != -1:
-                split_point = candidate + len(sep)
+        for sep in _SPLIT_SEPARATORS:
+            positions = offsets.get(sep)
+            if positions is None:
+                positions = offsets[sep] = [
+                    m.start() for m in re.finditer(f"(?={re.escape(sep)})", text)
+                ]
+            # Last occurrence that fits entirely inside [search_start, end)
+            i = bisect.bisect_right(positions, end - len(sep)) - 1
+            if i >= 0 and positions[i] >= search_start:
+                split_point = positions[i] + len(sep)
                 break
         if split_point == -1:
             split_point = end
-        chunks.append(text[start:split_point])
+        spans.append((start, split_point))
         next_start = split_point - overlap
         if next_start <= start:
             next_start = start + chunk_size - overlap
         start = max(start + 1, next_start)
-    return chunks
+    return spans
+
+
+def recursive_split(text, chunk_size, overlap):
+    if not text:
+        return []
+    return [
+        text[start:end]
+        for start, end in _split_spans(text, 0, len(text), chunk_size, overlap, {})
+    ]
 
 
-def save_parent_to_store(doc_id, part_index, text, filename):
-    parent_id = f"{doc_id}_{part_index}"
-    file_path = os.path.join(DOC_STORE_DIR, f"{parent_id}.json")
-    payload = {
-        "parent_id": parent_id,
-        "doc_id": doc_id,
-        "part_index": part_index,
-        "filename": filename,
-        "text": text,
-    }
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False)
-    return parent_id
+def split_parents_and_children(text):
+    """Returns [(parent_text, child_texts), ...], as recursive_split applied at both levels.
+
+    Children are split inside each parent's span of the original text, so both levels
+    share one set of separator offsets and no parent substring is scanned again.
+    """
+    if not text:
+        return []
+    offsets = {}
+    parents = []
+    for p_start, p_end in _split_spans(
+        text, 0, len(text), PARENT_CHUNK_SIZE, CHUNK_OVERLAP, offsets
+    ):
+        children = [
+            text[c_start:c_end]
+            for c_start, c_end in _split_spans(
+                text, p_start, p_end, CHILD_CHUNK_SIZE, CHUNK_OVERLAP, offsets
+            )
+        ]
+        parents.append((text[p_start:p_end], children))
+    return parents
+
+
+def save_parents_to_store(doc_id, filename, parent_texts):
+    """Writes all parents of a document as one DOC_STORE_DIR/<doc_id>.jsonl file.
+
+    One line per parent in part order; parent ids are "<doc_id>_<part_index>".
+    """
+    os.makedirs(DOC_STORE_DIR, exist_ok=True)
+    lines = []
+    for part_index, text in enumerate(parent_texts):
+        payload = {
+            "parent_id": f"{doc_id}_{part_index}",
+            "doc_id": doc_id,
+            "part_index": part_index,
+            "filename": filename,
+            "text": text,
+        }
+        if orjson is not None:
+            lines.append(orjson.dumps(payload))
+        else:
+            lines.append(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    with open(os.path.join(DOC_STORE_DIR, f"{doc_id}.jsonl"), "wb") as f:
+        f.write(b"\n".join(lines) + b"\n" if lines else b"")
 
 
 def sanitize_metadata(metadata):
@@ -140,14 +372,280 @@ def sanitize_metadata(metadata):
     return clean
 
 
+def encode_cached(model, texts):
+    """Encodes texts as lists of floats, reusing embeddings of identical texts seen this run."""
+    keys = [hashlib.sha1(text.encode("utf-8")).digest() for text in texts]
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key in _embedding_cache:
+            _embedding_cache.move_to_end(key)
+        elif key not in missing:
+            missing[key] = text
+    if missing:
+        import torch
+
+        with torch.inference_mode():
+            new_embeddings = model.encode(
+                list(missing.values()),
+                batch_size=ENCODE_BATCH_SIZE,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+        _embedding_cache.update(zip(missing, new_embeddings))
+    embeddings = [_embedding_cache[key].tolist() for key in keys]
+    while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+    return embeddings
+
+
+def add_chunks(collection, model, ids, texts, metadatas):
+    """Embeds a file's child chunks and upserts them, ADD_BATCH_SIZE at a time.
+
+    Chunk ids are deterministic, so upsert makes re-running a file idempotent, e.g.
+    one indexed after the last file index save of an interrupted run.
+
+    Each slice is encoded and written before the next one, so at most one slice of
+    embeddings is held as Python lists, and each upsert is one SQLite transaction.
+    """
+    for start in range(0, len(ids), ADD_BATCH_SIZE):
+        end = start + ADD_BATCH_SIZE
+        collection.upsert(
+            ids=ids[start:end],
+            embeddings=encode_cached(model, texts[start:end]),
+            metadatas=metadatas[start:end],
+            documents=texts[start:end],
+        )
+
+
+def file_is_unchanged(filepath, indexed_meta):
+    """Checks an already indexed file against its load_file_index entry.
+
+    mtime and size are compared first, so unchanged files are not read at all; the
+    content hash only runs when they differ.
+    """
+    filename = os.path.basename(filepath)
+    if not indexed_meta.get("file_hash"):
+        # Indexed before change tracking; nothing to compare against
+        return True
+    file_stat = os.stat(filepath)
+    if (file_stat.st_mtime, file_stat.st_size) == (
+        indexed_meta.get("file_mtime"),
+        indexed_meta.get("file_size"),
+    ):
+        return True
+    indexed_hash = indexed_meta["file_hash"]
+    if ":" not in indexed_hash:
+        # Stored before hashes carried their algorithm
+        indexed_hash = f"blake2b:{indexed_hash}"
+    algorithm = indexed_hash.split(":", 1)[0]
+    if algorithm == "xxh3" and xxhash is None:
+        algorithm = None
+    if get_file_hash(filepath, algorithm) == indexed_hash:
+        return True
+    logging.info(f"{filename} changed since it was indexed, re-indexing")
+    return False
+
+
+def record_file_stat(indexed_meta, filepath):
+    """Stores the current mtime and size of an unchanged file in its file index entry.
+
+    A touched but unmodified file then skips the hash on the next run.
+    """
+    file_stat = os.stat(filepath)
+    indexed_meta["file_mtime"] = file_stat.st_mtime
+    indexed_meta["file_size"] = file_stat.st_size
+
+
+def delete_stale_chunks(collection, filename, ids):
+    """Deletes chunks of a re-indexed file whose ids the new version did not write.
+
+    Runs after the new chunks are upserted, so the file stays searchable meanwhile and
+    a failed re-index leaves the previous version in place.
+    """
+    keep = set(ids)
+    indexed_ids = collection.get(where={"filename": filename}, include=[])["ids"]
+    stale = [chunk_id for chunk_id in indexed_ids if chunk_id not in keep]
+    if stale:
+        collection.delete(ids=stale)
+        logging.info(f"{filename}: deleted {len(stale)} chunks of the previous version")
+
+
+def file_index_path(collection):
+    return os.path.join(VECTOR_DB_DIR, f"{collection.name}_files.json")
+
+
+def load_file_index(collection):
+    """Returns {filename: {"file_hash", "file_mtime", "file_size"}} for indexed files.
+
+    Read from a small sidecar JSON next to the database. Only when it is missing (first
+    run after an upgrade, or a rebuilt database) are all chunk metadatas scanned, which
+    is also when older chunks get their source_label backfilled.
+    """
+    path = file_index_path(collection)
+    if os.path.isfile(path) and collection.count() > 0:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read {path}, rebuilding it: {e}")
+    file_index = {}
+    existing_data = collection.get(include=["metadatas"])
+    for meta in existing_data["metadatas"]:
+        if meta and "filename" in meta:
+            file_index[meta["filename"]] = {
+                "file_hash": meta.get("file_hash"),
+                "file_mtime": meta.get("file_mtime"),
+                "file_size": meta.get("file_size"),
+            }
+    backfill_source_labels(collection, existing_data["ids"], existing_data["metadatas"])
+    save_file_index(collection, file_index)
+    return file_index
+
+
+def save_file_index(collection, file_index):
+    path = file_index_path(collection)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(file_index, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def backfill_source_labels(collection, ids, metadatas, batch_size=500):
+    """Adds source_label to chunks indexed before labels were stored at ingest time."""
+    missing_ids = []
+    missing_metas = []
+    for chunk_id, meta in zip(ids, metadatas):
+        if meta and "filename" in meta and not meta.get("source_label"):
+            missing_ids.append(chunk_id)
+            missing_metas.append({**meta, "source_label": make_source_label(meta["filename"])})
+    for start in range(0, len(missing_ids), batch_size):
+        collection.update(
+            ids=missing_ids[start:start + batch_size],
+            metadatas=missing_metas[start:start + batch_size],
+        )
+    if missing_ids:
+        logging.info(f"{collection.name}: backfilled source_label for {len(missing_ids)} chunks")
+
+
+def apply_precision(model, device="cpu"):
+    """Converts a loaded torch model to EMBEDDING_PRECISION.
+
+    fp16 halves memory bandwidth on GPU; int8 uses dynamic quantization of the
+    Linear layers, which is what speeds up BERT matmuls on CPU.
+    """
+    import torch
+
+    if EMBEDDING_PRECISION == "fp16":
+        if device == "cpu":
+            logging.warning("E5_PRECISION=fp16 is not supported on CPU, using fp32")
+            return model
+        return model.half()
+    if EMBEDDING_PRECISION == "int8":
+        if device != "cpu":
+            logging.warning("E5_PRECISION=int8 is only supported on CPU, using fp32")
+            return model
+        return torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def onnx_model_file(onnx_dir):
+    """Returns the ONNX file to load for E5_PRECISION, quantizing model.onnx to INT8 on first use."""
+    if EMBEDDING_PRECISION != "int8":
+        return "model.onnx"
+    int8_path = os.path.join(onnx_dir, "model.int8.onnx")
+    if not os.path.isfile(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        logging.info(f"Quantizing {onnx_dir} to INT8")
+        quantize_dynamic(
+            os.path.join(onnx_dir, "model.onnx"),
+            int8_path,
+            weight_type=QuantType.QInt8,
+            op_types_to_quantize=["MatMul", "Gemm"],
+        )
+    return "model.int8.onnx"
+
+
+class OnnxEmbeddingModel:
+    """e5 on ONNX Runtime with the SentenceTransformer.encode interface used by ingestion.
+
+    Mean pooling + L2 normalization, as in the SentenceTransformer pipeline of e5.
+    The bot encodes queries with encode_batch of the same class, so queries and
+    chunks always go through identical preprocessing.
+    """
+
+    def __init__(self, onnx_dir, max_length=512, num_threads=INGEST_THREADS):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir, use_fast=True)
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            onnx_dir,
+            file_name=onnx_model_file(onnx_dir),
+            provider="CPUExecutionProvider",
+            session_options=session_options,
+        )
+        self.max_length = max_length
+
+    def encode_batch(self, texts):
+        """Encodes texts in one forward pass; returns a float32 (n, dim) array."""
+        batch = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        hidden = self.model(**batch).last_hidden_state
+        mask = batch["attention_mask"][..., None].astype(hidden.dtype)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled.astype(np.float32, copy=False)
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True, show_progress_bar=False):
+        if isinstance(texts, str):
+            return self.encode([texts], batch_size)[0]
+        # Longest first, like SentenceTransformer, so each batch pads to similar lengths
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        embeddings = np.empty((len(texts), self.model.config.hidden_size), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            embeddings[idx] = self.encode_batch([texts[i] for i in idx])
+        return embeddings
+
+
 def load_embedding_model():
+    """Loads e5 from ONNX_MODEL_DIR when optimum is installed, else the local SentenceTransformer."""
+    if os.path.isdir(ONNX_MODEL_DIR):
+        try:
+            model = OnnxEmbeddingModel(ONNX_MODEL_DIR)
+            logging.info(f"Using ONNX embedding model from {ONNX_MODEL_DIR}")
+            return model
+        except ImportError:
+            logging.info("optimum[onnxruntime] is not installed, using SentenceTransformer")
     os.makedirs(MODELS_DIR, exist_ok=True)
     local_dir = os.path.join(MODELS_DIR, "e5-small")
     if not os.path.isdir(local_dir) or not os.listdir(local_dir):
         logging.error(f"Local embedding model not found or empty: {local_dir}")
         raise RuntimeError(f"Local embedding model not found: {local_dir}")
-    model = SentenceTransformer(local_dir, device="cpu")
-    return model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(INGEST_THREADS)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once per process, e.g. not again for ingest_gk_only
+        pass
+    model = SentenceTransformer(local_dir, device="cpu").eval()
+    return apply_precision(model, "cpu")
 
 
 def is_gk4_filename(filename):
@@ -155,10 +653,15 @@ def is_gk4_filename(filename):
     return "гражданский кодекс российской федерации" in lower and "часть четвертая" in lower
 
 
+# Stdlib re rather than RE2: RE2's \s is ASCII-only and would miss the
+# non-breaking spaces common in legal texts ("Статья\xa01.")
+_GK_ARTICLE_RE = re.compile(r"(?m)^(Статья\s+(\d+[.\d]*)\..*?)\s*$")
+_GK_PARAGRAPH_RE = re.compile(r"^\s*(\d+(\.\d+)*)\.\s+")
+
+
 def split_gk4_into_articles(text):
     articles = []
-    pattern = re.compile(r"(?m)^(Статья\s+(\d+[.\d]*)\..*?)\s*$")
-    matches = list(pattern.finditer(text))
+    matches = list(_GK_ARTICLE_RE.finditer(text))
     if not matches:
         return articles
     for idx, match in enumerate(matches):
@@ -175,9 +678,8 @@ def split_gk4_article_children(article_text):
     lines = article_text.splitlines()
     chunks = []
     current = []
-    paragraph_re = re.compile(r"^\s*(\d+(\.\d+)*)\.\s+")
     for line in lines:
-        if paragraph_re.match(line):
+        if _GK_PARAGRAPH_RE.match(line):
             if current:
                 chunks.append("\n".join(current).strip())
                 current = []
@@ -190,21 +692,75 @@ def split_gk4_article_children(article_text):
     return cleaned
 
 
+def read_file(filepath):
+    """Extracts text by file extension; None for unsupported or unreadable files."""
+    lower = filepath.lower()
+    if lower.endswith(".pdf"):
+        return read_pdf(filepath)
+    if lower.endswith(".docx"):
+        return read_docx(filepath)
+    if lower.endswith(".xlsx") or lower.endswith(".xls"):
+        return read_excel(filepath)
+    return None
+
+
+def extract_chunks(filepath):
+    """Reads, hashes and splits one file; runs in a worker process.
+
+    Returns (file_hash, mtime, size, [(parent_text, child_texts), ...]) or None if
+    no text could be extracted.
+    """
+    text = read_file(filepath)
+    if not text:
+        return None
+    file_stat = os.stat(filepath)
+    parents = split_parents_and_children(text)
+    return get_file_hash(filepath), file_stat.st_mtime, file_stat.st_size, parents
+
+
+def extract_in_workers(filepaths):
+    """Yields (filepath, extract_chunks result) as worker processes finish files.
+
+    At most twice INGEST_WORKERS files are in flight, so extracted text does not pile
+    up while the main process is busy embedding.
+    """
+    paths = iter(filepaths)
+    with ProcessPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        pending = {
+            pool.submit(extract_chunks, path): path
+            for path in itertools.islice(paths, INGEST_WORKERS * 2)
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                filepath = pending.pop(future)
+                next_path = next(paths, None)
+                if next_path is not None:
+                    pending[pool.submit(extract_chunks, next_path)] = next_path
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error(f"Error extracting {filepath}: {e}")
+                    result = None
+                yield filepath, result
+
+
 def ingest_gk_only():
     logging.info("Starting GK4 ingestion into separate collection 'legal_gk'")
     if not os.path.exists(KNOWLEDGE_BASE_DIR):
         logging.error(f"{KNOWLEDGE_BASE_DIR} not found")
         return
 
+    import chromadb
+
     client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
-    collection = client.get_or_create_collection(name="legal_gk")
+    collection = client.get_or_create_collection(
+        name="legal_gk", metadata=COLLECTION_METADATA
+    )
 
-    existing_files = set()
+    existing_files = {}
     try:
-        existing_data = collection.get(include=["metadatas"])
-        for meta in existing_data.get("metadatas", []):
-            if meta and "filename" in meta:
-                existing_files.add(meta["filename"])
+        existing_files = load_file_index(collection)
     except Exception as e:
         logging.error(f"Error reading existing metadata for GK: {e}")
 
@@ -214,199 +770,230 @@ def ingest_gk_only():
         if not is_gk4_filename(filename):
             continue
 
-        if filename in existing_files:
-            logging.info(f"Skipping already indexed GK4 file: {filename}")
-            continue
-
         filepath = os.path.join(KNOWLEDGE_BASE_DIR, filename)
         if not os.path.isfile(filepath):
             continue
 
+        if filename in existing_files and file_is_unchanged(
+            filepath, existing_files[filename]
+        ):
+            record_file_stat(existing_files[filename], filepath)
+            logging.info(f"Skipping already indexed GK4 file: {filename}")
+            continue
+
         logging.info(f"Processing GK4 file: {filename}")
 
-        text = None
-        lower = filename.lower()
-        if lower.endswith(".pdf"):
-            text = read_pdf(filepath)
-        elif lower.endswith(".docx"):
-            text = read_docx(filepath)
-        elif lower.endswith(".xlsx") or lower.endswith(".xls"):
-            text = read_excel(filepath)
+        text = read_file(filepath)
 
         if not text:
             logging.error(f"No text extracted from {filename}, skipping")
             continue
 
         doc_id = get_doc_id(filename)
+        source_label = make_source_label(filename)
+        file_hash = get_file_hash(filepath)
+        file_stat = os.stat(filepath)
 
         articles = split_gk4_into_articles(text)
         if not articles:
             logging.warning(
                 f"{filename}: GK4 detection failed, falling back to generic splitting"
             )
-            parent_chunks = recursive_split(text, PARENT_CHUNK_SIZE, CHUNK_OVERLAP)
-            total_parents = len(parent_chunks)
+            parents = split_parents_and_children(text)
+            total_parents = len(parents)
             total_children = 0
-            for p_index, p_text in enumerate(parent_chunks):
-                parent_id = save_parent_to_store(doc_id, p_index, p_text, filename)
-                child_chunks = recursive_split(
-                    p_text, CHILD_CHUNK_SIZE, CHUNK_OVERLAP
-                )
+            child_ids, child_texts, child_metas = [], [], []
+            file_meta = sanitize_metadata({
+                "doc_id": doc_id,
+                "filename": filename,
+                "source_label": source_label,
+                "file_hash": file_hash,
+                "file_mtime": file_stat.st_mtime,
+                "file_size": file_stat.st_size,
+                "total_parts": total_parents,
+            })
+            save_parents_to_store(doc_id, filename, (p_text for p_text, _ in parents))
+            for p_index, (_, child_chunks) in enumerate(parents):
+                parent_id = f"{doc_id}_{p_index}"
+                parent_meta = {**file_meta, "parent_id": parent_id, "part_index": p_index}
                 for c_index, c_text in enumerate(child_chunks):
-                    child_id = f"{parent_id}_c{c_index}"
-                    metadata = {
-                        "parent_id": parent_id,
-                        "doc_id": doc_id,
-                        "filename": filename,
-                        "part_index": p_index,
-                        "total_parts": total_parents,
-                        "page_content": c_text,
-                    }
-                    clean_meta = sanitize_metadata(metadata)
-                    embedding = model.encode(c_text).tolist()
-                    collection.add(
-                        ids=[child_id],
-                        embeddings=[embedding],
-                        metadatas=[clean_meta],
-                        documents=[c_text],
-                    )
+                    child_ids.append(f"{parent_id}_c{c_index}")
+                    child_texts.append(c_text)
+                    child_metas.append({**parent_meta, "page_content": c_text})
                     total_children += 1
+            add_chunks(collection, model, child_ids, child_texts, child_metas)
+            if filename in existing_files:
+                delete_stale_chunks(collection, filename, child_ids)
+            existing_files[filename] = {
+                "file_hash": file_hash,
+                "file_mtime": file_stat.st_mtime,
+                "file_size": file_stat.st_size,
+            }
             logging.info(
                 f"{filename}: finished GK4 fallback parents={total_parents}, children={total_children}"
             )
-            gc.collect()
             continue
 
         total_parents = len(articles)
         logging.info(f"{filename}: GK4 mode, articles={total_parents}")
         total_children = 0
+        child_ids, child_texts, child_metas = [], [], []
+        file_meta = sanitize_metadata({
+            "doc_id": doc_id,
+            "filename": filename,
+            "source_label": source_label,
+            "file_hash": file_hash,
+            "file_mtime": file_stat.st_mtime,
+            "file_size": file_stat.st_size,
+            "total_parts": total_parents,
+        })
+        save_parents_to_store(doc_id, filename, (article_text for _, article_text in articles))
         for p_index, (article_number, article_text) in enumerate(articles):
-            parent_id = save_parent_to_store(doc_id, p_index, article_text, filename)
+            parent_id = f"{doc_id}_{p_index}"
             child_chunks = split_gk4_article_children(article_text)
             logging.info(
                 f"{filename}: article {article_number} ({p_index + 1}/{total_parents}) children={len(child_chunks)}"
             )
+            parent_meta = {
+                **file_meta,
+                "parent_id": parent_id,
+                "part_index": p_index,
+                "article_number": article_number,
+            }
             for c_index, c_text in enumerate(child_chunks):
-                child_id = f"{parent_id}_c{c_index}"
-                metadata = {
-                    "parent_id": parent_id,
-                    "doc_id": doc_id,
-                    "filename": filename,
-                    "part_index": p_index,
-                    "total_parts": total_parents,
-                    "page_content": c_text,
-                    "article_number": article_number,
-                }
-                clean_meta = sanitize_metadata(metadata)
-                embedding = model.encode(c_text).tolist()
-                collection.add(
-                    ids=[child_id],
-                    embeddings=[embedding],
-                    metadatas=[clean_meta],
-                    documents=[c_text],
-                )
+                child_ids.append(f"{parent_id}_c{c_index}")
+                child_texts.append(c_text)
+                child_metas.append({**parent_meta, "page_content": c_text})
                 total_children += 1
+        add_chunks(collection, model, child_ids, child_texts, child_metas)
+        if filename in existing_files:
+            delete_stale_chunks(collection, filename, child_ids)
+        existing_files[filename] = {
+            "file_hash": file_hash,
+            "file_mtime": file_stat.st_mtime,
+            "file_size": file_stat.st_size,
+        }
         logging.info(
             f"{filename}: finished GK4 articles={total_parents}, children={total_children}"
         )
-        gc.collect()
+
+    save_file_index(collection, existing_files)
 
 
 def ingest_documents():
+    """Indexes new and changed files from KNOWLEDGE_BASE_DIR."""
     logging.info("Starting ingestion")
     if not os.path.exists(KNOWLEDGE_BASE_DIR):
         logging.error(f"{KNOWLEDGE_BASE_DIR} not found")
         return
 
+    import chromadb
+
     client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
-    collection = client.get_or_create_collection(name=COLLECTION_NAME)
+    collection = client.get_or_create_collection(
+        name=COLLECTION_NAME, metadata=COLLECTION_METADATA
+    )
 
-    existing_files = set()
+    existing_files = {}
     try:
-        existing_data = collection.get(include=["metadatas"])
-        for meta in existing_data.get("metadatas", []):
-            if meta and "filename" in meta:
-                existing_files.add(meta["filename"])
+        existing_files = load_file_index(collection)
     except Exception as e:
         logging.error(f"Error reading existing metadata: {e}")
 
-    model = load_embedding_model()
-
+    filepaths = []
     for filename in os.listdir(KNOWLEDGE_BASE_DIR):
         if is_gk4_filename(filename):
             logging.info(f"Skipping GK4 file in main collection: {filename}")
             continue
 
-        if filename in existing_files:
-            logging.info(f"Skipping already indexed file: {filename}")
-            continue
-
         filepath = os.path.join(KNOWLEDGE_BASE_DIR, filename)
         if not os.path.isfile(filepath):
             continue
 
-        logging.info(f"Processing file: {filename}")
+        if filename in existing_files and file_is_unchanged(
+            filepath, existing_files[filename]
+        ):
+            record_file_stat(existing_files[filename], filepath)
+            logging.info(f"Skipping already indexed file: {filename}")
+            continue
 
-        text = None
-        lower = filename.lower()
-        if lower.endswith(".pdf"):
-            text = read_pdf(filepath)
-        elif lower.endswith(".docx"):
-            text = read_docx(filepath)
-        elif lower.endswith(".xlsx") or lower.endswith(".xls"):
-            text = read_excel(filepath)
+        filepaths.append(filepath)
 
-        if not text:
+    if not filepaths:
+        save_file_index(collection, existing_files)
+        logging.info("Ingestion complete, no new files")
+        return
+
+    model = load_embedding_model()
+
+    indexed_count = 0
+    for filepath, extracted in extract_in_workers(filepaths):
+        filename = os.path.basename(filepath)
+        if not extracted:
             logging.error(f"No text extracted from {filename}, skipping")
             continue
 
         doc_id = get_doc_id(filename)
-
-        parent_chunks = recursive_split(text, PARENT_CHUNK_SIZE, CHUNK_OVERLAP)
-        total_parents = len(parent_chunks)
-        logging.info(f"{filename}: parent chunks={total_parents}")
+        source_label = make_source_label(filename)
+        file_hash, file_mtime, file_size, parents = extracted
+        total_parents = len(parents)
+        logging.info(f"Processing file: {filename}, parent chunks={total_parents}")
 
         total_children = 0
-
-        for p_index, p_text in enumerate(parent_chunks):
-            parent_id = save_parent_to_store(doc_id, p_index, p_text, filename)
-
-            child_chunks = recursive_split(p_text, CHILD_CHUNK_SIZE, CHUNK_OVERLAP)
-            logging.info(
-                f"{filename}: parent {p_index + 1}/{total_parents} children={len(child_chunks)}"
-            )
-
+        child_ids, child_texts, child_metas = [], [], []
+        # File-level fields are sanitized once; per-parent fields below are never None
+        file_meta = sanitize_metadata({
+            "doc_id": doc_id,
+            "filename": filename,
+            "source_label": source_label,
+            "file_hash": file_hash,
+            "file_mtime": file_mtime,
+            "file_size": file_size,
+            "total_parts": total_parents,
+        })
+
+        save_parents_to_store(doc_id, filename, (p_text for p_text, _ in parents))
+        for p_index, (_, child_chunks) in enumerate(parents):
+            parent_id = f"{doc_id}_{p_index}"
+
+            # Only the text varies per child; the parent fields are built once here
+            parent_meta = {
+                **file_meta,
+                "parent_id": parent_id,
+                "part_index": p_index,
+                "prev_parent_id": f"{doc_id}_{p_index - 1}" if p_index > 0 else "",
+                "next_parent_id": f"{doc_id}_{p_index + 1}"
+                if p_index < total_parents - 1
+                else "",
+            }
             for c_index, c_text in enumerate(child_chunks):
-                child_id = f"{parent_id}_c{c_index}"
-                metadata = {
-                    "parent_id": parent_id,
-                    "doc_id": doc_id,
-                    "filename": filename,
-                    "part_index": p_index,
-                    "total_parts": total_parents,
-                    "page_content": c_text,
-                    "prev_parent_id": f"{doc_id}_{p_index - 1}" if p_index > 0 else None,
-                    "next_parent_id": f"{doc_id}_{p_index + 1}"
-                    if p_index < total_parents - 1
-                    else None,
-                }
-                clean_meta = sanitize_metadata(metadata)
-                embedding = model.encode(c_text).tolist()
-                collection.add(
-                    ids=[child_id],
-                    embeddings=[embedding],
-                    metadatas=[clean_meta],
-                    documents=[c_text],
-                )
+                child_ids.append(f"{parent_id}_c{c_index}")
+                child_texts.append(c_text)
+                child_metas.append({**parent_meta, "page_content": c_text})
                 total_children += 1
 
+        add_chunks(collection, model, child_ids, child_texts, child_metas)
+        if filename in existing_files:
+            delete_stale_chunks(collection, filename, child_ids)
+        existing_files[filename] = {
+            "file_hash": file_hash,
+            "file_mtime": file_mtime,
+            "file_size": file_size,
+        }
+        indexed_count += 1
+        if indexed_count % FILE_INDEX_SAVE_EVERY == 0:
+            save_file_index(collection, existing_files)
+            # Periodic full collection instead of one per file; refcounting frees the
+            # per-file text and chunk lists as soon as the next file replaces them
+            gc.collect()
         logging.info(
             f"{filename}: finished parents={total_parents}, children={total_children}"
         )
-        gc.collect()
 
+    save_file_index(collection, existing_files)
     logging.info("Ingestion complete")
 
 
 if __name__ == "__main__":
+    setup_logging()
     ingest_documents()
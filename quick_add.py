@@ -1,7 +1,7 @@
 import os, json, traceback
 import chromadb
 from sentence_transformers import SentenceTransformer
-from ingest import read_docx, get_doc_id, EMBEDDING_MODEL_NAME
+from ingest import read_docx, get_doc_id, make_source_label, EMBEDDING_MODEL_NAME, COLLECTION_METADATA
 
 out = {"steps": []}
 try:
@@ -9,7 +9,7 @@ try:
     model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
     out["steps"].append("model_loaded")
     c = chromadb.PersistentClient(path="vector_db")
-    col = c.get_or_create_collection("legal_rag")
+    col = c.get_or_create_collection("legal_rag", metadata=COLLECTION_METADATA)
     files = [f for f in os.listdir("knowledge_base") if f.endswith(".docx")]
     out["files"] = files
     if not files:
@@ -25,6 +25,7 @@ try:
             "parent_id": pid,
             "doc_id": doc_id,
             "filename": files[0],
+            "source_label": make_source_label(files[0]),
             "page_content": chunk,
             "part_index": 0,
             "total_parts": 1,
@@ -32,7 +33,7 @@ try:
             "next_parent_id": "",
         }
         emb = model.encode(chunk).tolist()
-        col.add(ids=[pid + "_c0"], embeddings=[emb], metadatas=[meta], documents=[chunk])
+        col.upsert(ids=[pid + "_c0"], embeddings=[emb], metadatas=[meta], documents=[chunk])
         out["added"] = True
         out["count"] = col.count()
 except Exception as e: